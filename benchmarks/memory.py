@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+#
+# Memory benchmark of cl2nc.
+#
+# Measures peak RSS and tracemalloc allocations of reading (read_dat,
+# read_his) and writing (write_output) synthetic CL31, CL51 and CT25K input
+# files covering a day, a month or a year. Every measurement runs in a separate
+# process. peak_blocks is the peak increase in the number of allocated Python
+# memory blocks during a stage, which grows with per-record objects kept alive.
+# retained_blocks is the number of blocks still allocated after the stage.
+# The input of the write stage is parsed once and loaded from .npy files, so
+# that the measurement does not depend on memory left over from parsing.
+# rss_increase and peak_blocks are sampled and vary between runs, so the median
+# of several runs is reported.
+#
+# Usage:
+#
+#     python3 benchmarks/memory.py [-d day|month|year]... [-o results.json]
+#         [-b baseline.json] [--tolerance 0.1] [-n 3]
+#
+# With -b, the command fails if any metric exceeds the corresponding value in
+# the baseline (a results file produced with -o) by more than the tolerance
+# plus the absolute slack in SLACK.
+
+import sys
+import os
+import json
+import argparse
+import statistics
+import threading
+import resource
+import subprocess
+import shutil
+import tempfile
+import tracemalloc
+import datetime as dt
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+DURATIONS = {
+    'day': 1,
+    'month': 30,
+    'year': 365,
+}
+
+# Instrument, input format, sampling interval (s).
+CASES = [
+    ('cl31', 'dat', 16),
+    ('cl51', 'dat', 16),
+    ('ct25k', 'dat', 30),
+    ('cl51', 'his', 16),
+]
+
+STAGES = ['read', 'write']
+
+METRICS = ['rss_increase', 'tracemalloc_peak', 'peak_blocks',
+    'retained_blocks']
+
+# Metrics measured in runs without tracing, which are repeated.
+SAMPLED_METRICS = ['rss_increase', 'peak_blocks']
+
+# Absolute increase allowed in addition to the relative tolerance, covering
+# the noise of small measurements.
+SLACK = {
+    'rss_increase': 16e6,
+    'tracemalloc_peak': 1e6,
+    'peak_blocks': 2000,
+    'retained_blocks': 1000,
+}
+
+def hex_values(n, k, seed):
+    return b''.join([
+        b'%0*X' % (k, (i*seed + 31*seed) % 4096)
+        for i in range(n)
+    ])
+
+def dat_record(instrument, t, i):
+    time = t.strftime('-%Y-%m-%d %H:%M:%S').encode('ascii')
+    if instrument == 'ct25k':
+        return b'\r\n'.join([
+            time,
+            b'\x01CTA2020\x02',
+            b'10 01230 ///// ///// 00000100',
+            b'100 N 100 +25 099 0100 000 0100 LF2HN1 139',
+        ] + [
+            b'%03d' % (j*16) + hex_values(16, 4, i % 7 + j + 1)
+            for j in range(16)
+        ] + [
+            b'\x03',
+        ]) + b'\r\n'
+    nsamples = 770 if instrument == 'cl31' else 1540
+    return b'\r\n'.join([
+        time,
+        b'\x01CL%s%03d26\x02' % (
+            b'A' if instrument == 'cl31' else b'0',
+            2 if instrument == 'cl31' else 1
+        ),
+        b'10 01230 ///// ///// 000000000080',
+        b'  1 0030 0 //// 0 //// 0 //// 0 ////',
+        b'00100 10 %04d 100 +33 099 00 0110 L0016HN15 139' % nsamples,
+        hex_values(nsamples, 5, i % 7 + 1),
+        b'\x03ABCD\x04',
+    ]) + b'\r\n'
+
+def his_record(t, i):
+    return t.strftime('%Y-%m-%d %H:%M:%S').encode('ascii') + \
+        b', CL51, 16, ' + hex_values(1540, 5, i % 7 + 1) + b'\r\n'
+
+def generate(filename, instrument, format_, interval, days):
+    t0 = dt.datetime(2020, 1, 1)
+    n = int(days*86400/interval)
+    # Records are cached by their content, which repeats every 7 records.
+    cache = {}
+    with open(filename, 'wb') as f:
+        if format_ == 'his':
+            f.write(b'History file\r\nCREATEDATE, CEILOMETER, PERIOD, BS_PROFILE\r\n')
+        for i in range(n):
+            t = t0 + dt.timedelta(seconds=i*interval)
+            if format_ == 'his':
+                f.write(his_record(t, i))
+            else:
+                if i % 7 not in cache:
+                    cache[i % 7] = dat_record(instrument, t0, i)
+                x = cache[i % 7]
+                f.write(t.strftime('-%Y-%m-%d %H:%M:%S').encode('ascii') + \
+                    x[x.index(b'\r\n'):])
+    return n
+
+def rss_peak():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def rss_reset():
+    # Reset the peak RSS (Linux only).
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def sample_blocks(stop, res):
+    while not stop.wait(0.001):
+        res['peak_blocks'] = max(res['peak_blocks'], sys.getallocatedblocks())
+
+def child(filename, stage, trace):
+    import cl2nc
+    options = {'check': False, 'time': None, 'sampling_rate': None}
+    filename = os.fsencode(filename)
+    res = {}
+    if stage == 'write':
+        # filename is a cache entry of the parsed input.
+        c = {k: np.array(v) for k, v in cl2nc.cache_load(filename).items()}
+        output = tempfile.NamedTemporaryFile(suffix='.nc', delete=False)
+        output.close()
+        if not rss_reset() and not trace:
+            res['rss_reset'] = False
+    if trace:
+        tracemalloc.start()
+    else:
+        blocks_before = sys.getallocatedblocks()
+        res['peak_blocks'] = blocks_before
+        stop = threading.Event()
+        sampler = threading.Thread(target=sample_blocks, args=(stop, res))
+        sampler.start()
+    rss_before = rss_peak()
+    if stage == 'read':
+        c = cl2nc.read(filename, options)
+    else:
+        cl2nc.write_output(c, os.fsencode(output.name))
+        os.unlink(output.name)
+    if trace:
+        snapshot = tracemalloc.take_snapshot()
+        res['tracemalloc_peak'] = tracemalloc.get_traced_memory()[1]
+        res['retained_blocks'] = sum([
+            x.count for x in snapshot.statistics('filename')
+        ])
+        tracemalloc.stop()
+    else:
+        stop.set()
+        sampler.join()
+        res['peak_blocks'] -= blocks_before
+        res['peak_rss'] = rss_peak()
+        res['rss_increase'] = res['peak_rss'] - rss_before
+    print(json.dumps(res))
+
+def run_child(filename, stage, trace):
+    p = subprocess.run([
+        sys.executable, __file__, '--child', filename, stage,
+    ] + (['--trace'] if trace else []),
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    return json.loads(p.stdout.decode('utf-8').splitlines()[-1])
+
+def measure(filename, stage, repeat):
+    runs = [run_child(filename, stage, False) for i in range(repeat)]
+    res = runs[0]
+    for metric in SAMPLED_METRICS:
+        res[metric] = statistics.median([x[metric] for x in runs])
+    res.update(run_child(filename, stage, True))
+    return res
+
+def compare(results, baseline, tolerance):
+    failed = []
+    for key, res in results.items():
+        if key not in baseline:
+            continue
+        for metric in METRICS:
+            x = res.get(metric)
+            y = baseline[key].get(metric)
+            if x is None or y is None:
+                continue
+            if x > y*(1 + tolerance) + SLACK[metric]:
+                failed += [(key, metric, x, y)]
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory benchmark of cl2nc')
+    parser.add_argument('-d',
+        dest='durations',
+        action='append',
+        choices=list(DURATIONS.keys()),
+        help='input duration (can be specified multiple times, default: day)',
+    )
+    parser.add_argument('-o',
+        dest='output',
+        help='write results to a JSON file',
+    )
+    parser.add_argument('-b',
+        dest='baseline',
+        help='fail if results regress compared to a baseline JSON file',
+    )
+    parser.add_argument('--tolerance',
+        dest='tolerance',
+        type=float,
+        default=0.1,
+        help='allowed relative increase compared to the baseline (default: 0.1)',
+    )
+    parser.add_argument('-n',
+        dest='repeat',
+        type=int,
+        default=3,
+        help='number of runs of which the median is taken (default: 3)',
+    )
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    parser.add_argument('--trace', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        child(args.child[0], args.child[1], args.trace)
+        return
+
+    import cl2nc
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for duration in args.durations or ['day']:
+            for instrument, format_, interval in CASES:
+                filename = os.path.join(tmp, '%s_%s.%s' % (
+                    instrument, duration, format_
+                ))
+                n = generate(filename, instrument, format_, interval,
+                    DURATIONS[duration])
+                entry = os.path.join(tmp, 'entry')
+                cl2nc.cache_store(os.fsencode(entry), cl2nc.read(
+                    os.fsencode(filename),
+                    {'check': False, 'time': None, 'sampling_rate': None},
+                ))
+                for stage in STAGES:
+                    key = '%s/%s/%s/%s' % (instrument, format_, duration, stage)
+                    res = measure(filename if stage == 'read' else entry,
+                        stage, args.repeat)
+                    res['records'] = n
+                    res['bytes_per_record'] = res['rss_increase']/n
+                    res['blocks_per_record'] = res['peak_blocks']/n
+                    results[key] = res
+                    print('%-28s %9d records %8.1f MB RSS %8.1f MB traced %9d peak blocks %9d retained blocks %8.0f B/record %6.1f blocks/record' % (
+                        key,
+                        n,
+                        res['rss_increase']/1e6,
+                        res['tracemalloc_peak']/1e6,
+                        res['peak_blocks'],
+                        res['retained_blocks'],
+                        res['bytes_per_record'],
+                        res['blocks_per_record'],
+                    ))
+                    sys.stdout.flush()
+                os.unlink(filename)
+                shutil.rmtree(entry)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        failed = compare(results, baseline, args.tolerance)
+        for key, metric, x, y in failed:
+            print('%s: %s regressed from %d to %d' % (key, metric, y, x),
+                file=sys.stderr)
+        if len(failed) > 0:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
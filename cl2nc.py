@@ -1,18 +1,30 @@
 #!/usr/bin/env python3
 
-__version__ = '3.8.1'
+__version__ = '4.0.0'
 
 import sys
 import signal
+import errno
 signal.signal(signal.SIGINT, lambda signal, frame: sys.exit(0))
 import logging
 logging.basicConfig(format='%(name)s: %(message)s')
 log = logging.getLogger(sys.argv[0])
 import os
+import io
+import threading
+import queue
+import asyncio
+import concurrent.futures
+import shutil
+import tempfile
+import hashlib
 import traceback
 import re
+import fnmatch
 import itertools
 import argparse
+import json
+import csv
 import datetime as dt
 import numpy as np
 from netCDF4 import Dataset
@@ -20,6 +32,50 @@ from netCDF4 import Dataset
 NA_INT32 = -1<<31
 NA_INT64 = -1<<63
 
+PIPELINE_QUEUE_SIZE = 2
+
+# Maximum number of records and maximum time (s) records are kept in listen
+# mode for retrying when the output file cannot be written.
+PENDING_SIZE = 1000
+PENDING_AGE = 3600
+
+# Errors which may be resolved by retrying later. NC_EHDFERR (-101) is
+# reported when the output file is locked by a reader.
+TRANSIENT_ERRORS = [-101, errno.EAGAIN, errno.EBUSY, errno.ENOSPC]
+
+ROLL_FORMAT = {
+    'hour': '%Y%m%dT%H',
+    'day': '%Y%m%d',
+}
+
+# Variables which are usually constant in a file. With compact encoding, they
+# are stored as scalar variables when constant.
+COMPACT_VARS = [
+    'id',
+    'unit',
+    'software_level',
+    'message_subclass',
+    'pulse_length',
+    'receiver_gain',
+    'receiver_bandwidth',
+    'measurement_mode',
+    'vertical_resolution',
+    'ceilometer',
+    'scale',
+]
+
+# Encodings of backscatter in the output file: floating-point values, raw
+# integer counts, or raw integer counts delta-encoded along time.
+BACKSCATTER_ENCODINGS = ['float', 'counts', 'delta']
+
+# Missing raw count in delta-encoded backscatter. The value is outside of the
+# range of valid counts.
+MISSING_COUNT = 1<<24
+
+# String variables with few distinct values. With compact encoding, they are
+# stored as enumerated types when not constant.
+ENUM_VARS = ['id', 'ceilometer']
+
 NA_NETCDF = {
     'i4': NA_INT32,
     'i8': NA_INT64,
@@ -44,6 +100,9 @@ re_line6 = re.compile(br'^(?:' + b'\x03|\xef\xbf\xbd' + br')?(?P<checksum>.{4})(
 re_line20ct = re.compile(br'^(?:' + b'\x03|\xef\xbf\xbd' + br')$')
 re_none = re.compile(br'^/* *$')
 
+re_cache_key = re.compile(br'^[0-9a-f]{64}$')
+re_enum_name = re.compile(br'^[A-Za-z_][A-Za-z0-9_]*$')
+
 re_his_time = re.compile(br'^(?P<year>\d{4})-(?P<month>\d\d)-(?P<day>\d\d) (?P<hour>\d\d):(?P<minute>\d\d):(?P<second>\d\d)$')
 
 def fsencode(x):
@@ -52,12 +111,40 @@ def fsencode(x):
 def fsdecode(x):
     return os.fsdecode(x) if sys.version_info[0] > 2 else x
 
+def read_lines(filename, data=None):
+    if data is None:
+        with open(filename, 'rb') as f:
+            return f.readlines()
+    if hasattr(data, 'readlines'):
+        return data.readlines()
+    if isinstance(data, bytes):
+        return io.BytesIO(data).readlines()
+    # Split the buffer into lines without copying it as a whole.
+    buf = memoryview(data).cast('B')
+    ends = np.flatnonzero(np.frombuffer(buf, np.uint8) == ord(b'\n')) + 1
+    if len(ends) == 0 or ends[-1] != len(buf):
+        ends = np.append(ends, len(buf))
+    starts = np.concatenate([[0], ends[:-1]])
+    return [buf[i:j].tobytes() for i, j in zip(starts, ends) if j > i]
+
+def input_format(filename=None, format=None):
+    if format is not None:
+        if format not in ('dat', 'his'):
+            raise ValueError('Invalid input format "%s"' % format)
+        return format
+    if filename is not None and fsencode(filename).lower().endswith(b'.his'):
+        return 'his'
+    return 'dat'
+
 def is_none(s):
     return re_none.match(s)
 
 def int_to_float(x):
     return np.where(x != NA_INT32, x, np.nan)
 
+def count_divisor(id_):
+    return 10000 if id_ == b'CT' else 100000
+
 def read_int(d, g, var):
     d[var] = int(g[var]) if not is_none(g[var]) else NA_INT32
 
@@ -256,46 +343,82 @@ def check(d):
     if 'checksum' in d and crc16(d['message']) != d['checksum']:
         raise ValueError('Invalid checksum')
 
-def postprocess(d):
-    id_ = d.get('id')
+def postprocess_time(d):
+    if 'time_utc' in d and 'time' not in d:
+        d['time'] = np.nan if d['time_utc'] == '' else (
+            dt.datetime.strptime(
+                d['time_utc'].decode('ascii'),
+                '%Y-%m-%dT%H:%M:%S'
+            ) - dt.datetime(1970, 1, 1)
+        ).total_seconds()
+
+    if 'time' in d and 'time_utc' not in d:
+        d['time_utc'] = '' if np.isnan(d['time']) else (
+            dt.datetime(1970, 1, 1) + dt.timedelta(seconds=d['time'])
+        ).strftime('%Y-%m-%dT%H:%M:%S').encode('ascii')
+
+    d['time_utc'] = d.get('time_utc', '')
+    d['time'] = d.get('time', np.nan)
+
+def to_columns(dd):
+    vars = list(set(itertools.chain(*[list(d.keys()) for d in dd])))
+    c = {}
+    for var in vars:
+        x = [d[var] for d in dd]
+        if len(x) > 0 and isinstance(x[0], np.ndarray):
+            m = np.max([0] + [len(y) for y in x])
+            c[var] = np.full((len(x), m), np.nan, np.float64)
+            for i, y in enumerate(x):
+                c[var][i, 0:len(y)] = y
+        else:
+            c[var] = np.array(x)
+    return c
+
+def postprocess(dd):
+    if len(dd) == 0:
+        return {}
+
+    c = to_columns(dd)
+    n = len(dd)
+    id_ = c['id'][0] if 'id' in c else None
 
     for var in [
         'backscatter',
         'scale',
         'backscatter_sum',
     ]:
-        if var in d: d[var] = int_to_float(d[var])
+        if var in c: c[var] = int_to_float(c[var])
 
-    d['scale'] = d.get('scale', 10)
+    c['scale'] = c.get('scale', np.full(n, 10))
 
-    scale_factor = 10000 if id_ == b'CT' else 100000
+    if 'backscatter' in c:
+        c['backscatter'] = c['backscatter']/count_divisor(id_)* \
+            (c['scale'][:,np.newaxis]/100)
 
-    if 'backscatter' in d:
-        d['backscatter'] = d['backscatter']/scale_factor*(d['scale']/100)
+    if 'backscatter_sum' in c:
+        c['backscatter_sum'] = c['backscatter_sum']/10000*(c['scale']/100)
 
-    if 'backscatter_sum' in d:
-        d['backscatter_sum'] = d['backscatter_sum']/10000*(d['scale']/100)
+    if 'status_internal' in c:
+        c['units'] = np.where(c['status_internal'] & 0x0080, 'm', 'ft')
+        layer_height_factor = np.where(c['units'] == 'ft', 100, 10)
 
-    if 'status_internal' in d:
-        d['units'] = 'm' if (d['status_internal'] & 0x0080) else 'ft'
-        layer_height_factor = 100 if d['units'] == 'ft' else 10
-
-    if 'layer1_height' in d:
-        d['layer_height'] = NA_INT32*np.ones(5)
-        for i in range(5):
-            d['layer_height'][i] = d['layer%d_height' % (i + 1)]
-        d['layer_height'] = np.where(
-            d['layer_height'] != NA_INT32,
-            d['layer_height']*layer_height_factor,
+    if 'layer1_height' in c:
+        c['layer_height'] = np.stack([
+            c['layer%d_height' % (i + 1)] for i in range(5)
+        ], axis=1).astype(np.float64)
+        c['layer_height'] = np.where(
+            c['layer_height'] != NA_INT32,
+            c['layer_height']*layer_height_factor[:,np.newaxis],
             NA_INT32
         )
 
-    if 'layer1_cloud_amount' in d:
-        d['layer_cloud_amount'] = NA_INT32*np.ones(5)
-        for i in range(5):
-            d['layer_cloud_amount'][i] = d['layer%d_cloud_amount' % (i + 1)]
+    if 'layer1_cloud_amount' in c:
+        c['layer_cloud_amount'] = np.stack([
+            c['layer%d_cloud_amount' % (i + 1)] for i in range(5)
+        ], axis=1).astype(np.float64)
 
-    if 'units' in d and d['units'] == 'ft':
+    if 'units' in c and np.any(c['units'] == 'ft'):
+        ft = c['units'] == 'ft'
         for var in [
             'vertical_visibility',
             'layer_height',
@@ -303,45 +426,33 @@ def postprocess(d):
             'cbh_2',
             'cbh_3',
         ]:
-            if var in d:
-                d[var] = np.where(
-                    d[var] != NA_INT32,
-                    d[var]*0.3048,
-                    NA_INT32
+            if var in c:
+                mask = ft if c[var].ndim == 1 else ft[:,np.newaxis]
+                c[var] = np.where(
+                    mask & (c[var] != NA_INT32),
+                    c[var]*0.3048,
+                    c[var]
                 )
 
-    if 'pulse_count' in d:
-        d['pulse_count'] = np.where(
-            d['pulse_count'] != NA_INT32,
-            4**(d['pulse_count'] + 1) if id_ == b'CT' \
-                else d['pulse_count']*1024,
+    if 'pulse_count' in c:
+        valid = c['pulse_count'] != NA_INT32
+        x = np.where(valid, c['pulse_count'], 0)
+        c['pulse_count'] = np.where(
+            valid,
+            4**(x + 1) if id_ == b'CT' else x*1024,
             NA_INT32
         )
 
-    if 'sampling' in d:
+    if 'sampling' in c:
         if id_ == b'CT':
-            d['sampling'] *= 10e6
+            c['sampling'] = c['sampling']*10e6
         else:
-            d['sampling'] *= 1e6
-
-    if 'time_utc' in d and 'time' not in d:
-        d['time'] = np.nan if d['time_utc'] == '' else (
-            dt.datetime.strptime(
-                d['time_utc'].decode('ascii'),
-                '%Y-%m-%dT%H:%M:%S'
-            ) - dt.datetime(1970, 1, 1)
-        ).total_seconds()
-
-    if 'time' in d and 'time_utc' not in d:
-        d['time_utc'] = '' if np.isnan(d['time']) else (
-            dt.datetime(1970, 1, 1) + dt.timedelta(seconds=d['time'])
-        ).strftime('%Y-%m-%dT%H:%M:%S').encode('ascii')
-
-    d['time_utc'] = d.get('time_utc', '')
-    d['time'] = d.get('time', np.nan)
+            c['sampling'] = c['sampling']*1e6
 
     if id_ == b'CT':
-        d['vertical_resolution'] = 30
+        c['vertical_resolution'] = np.full(n, 30)
+
+    return c
 
 def crc16(buf):
     crc = 0xffff
@@ -353,112 +464,148 @@ def crc16(buf):
             crc = (crc^xmask) & 0xffff
     return crc^0xffff;
 
-def read_dat(filename, options={}):
-    options = dict({
-        'check': False,
-    }, **options)
-
-    with open(filename, 'rb') as f:
-        d = {}
-        dd = []
-        stage = 0
-
-        def finalize(d):
-            if options['check']: check(d)
-            if 'time_utc' not in d and 'time' not in d:
-                if len(dd) == 0 and options['time']:
-                    d['time'] = options['time']
-                elif len(dd) > 0 and \
-                    'time' in dd[-1] and \
-                    options['sampling_rate']:
-                    d['time'] = dd[-1]['time'] + options['sampling_rate']
-            postprocess(d)
-            if len(dd) > 0 and d['id'] != dd[0]['id']:
-                raise ValueError('Mixed ceilometer types in one input file are not supported')
-            dd.append(d)
-
-        lines = f.readlines()
-        for n, line in enumerate(lines):
-            line_number = n + 1
-            eof = line_number == len(lines)
-            linex = line.rstrip()
-
-            if linex == b'':
-                continue
-
-            if linex.startswith(b'-') and not re_line_time_1.match(linex):
-                continue
-
-            if linex.startswith(b'=') and not re_line_time_3.match(linex):
-                continue
-
-            while True:
-                try:
-                    if stage == 0:
-                        d = {}
-                        try: line_time(d, linex, filename)
-                        except ValueError:
-                            stage = 1
-                            continue
+class DatParser(object):
+    def __init__(self, filename=None, options={}, clock=None):
+        self.options = dict({
+            'check': False,
+            'scan': False,
+            'time': None,
+            'sampling_rate': None,
+        }, **options)
+        self.filename = filename
+        self.clock = clock
+        self.dd = []
+        self.errors = 0
+        self.d = {}
+        self.stage = 0
+        self.substage = 0
+        self.id = None
+        self.last = None
+        self.start_time = None
+
+    def finalize(self, d):
+        options = self.options
+        if options['check']: check(d)
+        if 'time_utc' not in d and 'time' not in d:
+            if self.last is None and options['time']:
+                d['time'] = options['time']
+            elif self.last is not None and \
+                'time' in self.last and \
+                options['sampling_rate']:
+                d['time'] = self.last['time'] + options['sampling_rate']
+            elif self.start_time is not None:
+                d['time'] = self.start_time
+        postprocess_time(d)
+        # Line 6 is optional, so the checksum is not present in all records.
+        d.pop('message', None)
+        d.pop('checksum', None)
+        if self.id is not None and d['id'] != self.id:
+            raise ValueError('Mixed ceilometer types in one input file are not supported')
+        self.id = d['id']
+        self.last = d
+        self.dd.append(d)
+
+    def feed(self, line, line_number):
+        options = self.options
+        d = self.d
+        stage = self.stage
+        substage = self.substage
+        linex = line.rstrip()
+
+        if linex == b'':
+            return
+
+        if linex.startswith(b'-') and not re_line_time_1.match(linex):
+            return
+
+        if linex.startswith(b'=') and not re_line_time_3.match(linex):
+            return
+
+        while True:
+            try:
+                if stage == 0:
+                    d = {}
+                    if self.clock is not None:
+                        self.start_time = self.clock()
+                    try: line_time(d, linex, self.filename)
+                    except ValueError:
                         stage = 1
-                    elif stage == 1:
-                        line1(d, linex)
-                        d['message'] = line[1:]
-                        stage = 2
-                    elif stage == 2:
-                        line2(d, linex)
-                        d['message'] += line
-                        if d['id'] == b'CT' or d['message_number'] == 2:
-                            stage = 3
-                        else:
-                            stage = 4
-                    elif stage == 3:
-                        if d['id'] == b'CT':
-                            line3ct(d, linex)
-                        else:
-                            line3(d, linex)
-                        d['message'] += line
+                        continue
+                    stage = 1
+                elif stage == 1:
+                    line1(d, linex)
+                    d['message'] = line[1:]
+                    stage = 2
+                elif stage == 2:
+                    line2(d, linex)
+                    d['message'] += line
+                    if d['id'] == b'CT' or d['message_number'] == 2:
+                        stage = 3
+                    else:
                         stage = 4
-                        substage = 1
-                    elif stage == 4:
-                        if d['id'] == b'CT':
+                elif stage == 3:
+                    if d['id'] == b'CT':
+                        line3ct(d, linex)
+                    else:
+                        line3(d, linex)
+                    d['message'] += line
+                    stage = 4
+                    substage = 1
+                elif stage == 4:
+                    if d['id'] == b'CT':
+                        if not options['scan']:
                             line4ct(d, linex)
-                        else:
-                            line4(d, linex)
-                        d['message'] += line
-                        if d['id'] == b'CT' and substage < 16:
-                            stage = 4
-                            substage += 1
-                        else:
-                            stage = 5
-                    elif stage == 5:
-                        if d['id'] == b'CT':
-                            line20ct(d, linex)
-                        else:
-                            line5(d, linex)
-                        d['message'] += line
-                        if d['id'] == b'CT':
-                            finalize(d)
-                            stage = 0
-                        else:
-                            stage = 6
-                    elif stage == 6:
-                        if re_line6.match(linex):
-                            line6(d, linex)
-                            d['message'] += line[0:1]
-                        finalize(d)
+                    else:
+                        line4(d, linex)
+                    d['message'] += line
+                    if d['id'] == b'CT' and substage < 16:
+                        stage = 4
+                        substage += 1
+                    else:
+                        stage = 5
+                elif stage == 5:
+                    if d['id'] == b'CT':
+                        line20ct(d, linex)
+                    elif not options['scan']:
+                        line5(d, linex)
+                    d['message'] += line
+                    if d['id'] == b'CT':
+                        self.finalize(d)
                         stage = 0
                     else:
-                        raise RuntimeError('Invalid decoding stage')
-                except Exception as e:
-                    t, v, tb = sys.exc_info()
-                    log.warning('Error on line %d: %s' % (
-                        line_number, e
-                    ))
-                    log.debug(traceback.format_exc())
+                        stage = 6
+                elif stage == 6:
+                    if re_line6.match(linex):
+                        line6(d, linex)
+                        d['message'] += line[0:1]
+                    self.finalize(d)
                     stage = 0
-                break
-        return dd
+                else:
+                    raise RuntimeError('Invalid decoding stage')
+            except Exception as e:
+                t, v, tb = sys.exc_info()
+                log.warning('Error on line %d: %s' % (
+                    line_number, e
+                ))
+                log.debug(traceback.format_exc())
+                self.errors += 1
+                stage = 0
+            break
+
+        self.d = d
+        self.stage = stage
+        self.substage = substage
+
+def read_dat_records(filename, options={}, data=None):
+    filename = fsencode(filename) if filename is not None else None
+    parser = DatParser(filename, options)
+    for n, line in enumerate(read_lines(filename, data)):
+        parser.feed(line, n + 1)
+    return parser.dd, parser.errors
+
+def read_dat(filename, options={}, data=None):
+    dd, _ = read_dat_records(filename, options, data)
+    return postprocess(dd)
 
 def read_his_time(d, s):
     m = re_his_time.match(s)
@@ -484,97 +631,413 @@ def read_his_period(d, s):
 def read_his_backscatter(d, s):
     read_hex_array(d, {'backscatter': s}, 'backscatter', 5)
 
-def read_his(filename, options={}):
+def read_his_records(filename, options={}, data=None):
+    options = dict({
+        'scan': False,
+        'time': None,
+        'sampling_rate': None,
+    }, **options)
+
+    lines = read_lines(filename, data)
+    dd = []
+    errors = 0
+    header = None
+    for n, line in enumerate(lines):
+        line_number = n + 1
+        try:
+            d = {}
+            items = line.split(b',')
+            items = [x.strip() for x in items]
+            if items[0] == b'History file':
+                continue
+            if header is None:
+                header = items
+                continue
+            for i, h in enumerate(header):
+                s = items[i] if i < len(items) else b''
+                if h == b'CREATEDATE':
+                    read_his_time(d, s)
+                elif h == b'CEILOMETER':
+                    d['ceilometer'] = s
+                elif h == b'PERIOD':
+                    read_his_period(d, s)
+                elif h == b'BS_PROFILE' and not options['scan']:
+                    read_his_backscatter(d, s)
+            postprocess_time(d)
+            dd += [d]
+        except Exception as e:
+            t, v, tb = sys.exc_info()
+            log.warning('Error on line %d: %s' % (
+                line_number, e
+            ))
+            log.debug(traceback.format_exc())
+            errors += 1
+    return dd, errors
+
+def read_his(filename, options={}, data=None):
+    dd, _ = read_his_records(filename, options, data)
+    return postprocess(dd)
+
+def file_hash(filename, data=None):
+    h = hashlib.sha256()
+    if data is not None:
+        h.update(data)
+        return h.hexdigest()
     with open(filename, 'rb') as f:
-        dd = []
-        header = None
-        for n, line in enumerate(f.readlines()):
-            line_number = n + 1
-            try:
-                d = {}
-                items = line.split(b',')
-                items = [x.strip() for x in items]
-                if items[0] == b'History file':
-                    continue
-                if header is None:
-                    header = items
-                    continue
-                for i, h in enumerate(header):
-                    s = items[i] if i < len(items) else b''
-                    if h == b'CREATEDATE':
-                        read_his_time(d, s)
-                    elif h == b'CEILOMETER':
-                        d['ceilometer'] = s
-                    elif h == b'PERIOD':
-                        read_his_period(d, s)
-                    elif h == b'BS_PROFILE':
-                        read_his_backscatter(d, s)
-                postprocess(d)
-                dd += [d]
-            except Exception as e:
-                t, v, tb = sys.exc_info()
-                log.warning('Error on line %d: %s' % (
-                    line_number, e
-                ))
-                log.debug(traceback.format_exc())
-    return dd
+        for buf in iter(lambda: f.read(1<<20), b''):
+            h.update(buf)
+    return h.hexdigest()
 
-def read(filename, options={}):
-    filename_lower = filename.lower()
-    if filename_lower.endswith(b'.his'):
-        return read_his(filename, options)
-    else:
-        return read_dat(filename, options)
+def cache_key(filename, options, data=None, format=None):
+    mf = re_file_time.match(filename) if filename is not None else None
+    key = repr((
+        file_hash(filename, data),
+        __version__,
+        input_format(filename, format),
+        mf.groups() if mf is not None else None,
+        options.get('check'),
+        options.get('time'),
+        options.get('sampling_rate'),
+    ))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest().encode('ascii')
+
+def cache_load(path):
+    c = {}
+    with open(os.path.join(path, b'vars'), 'rb') as f:
+        vars_ = f.read().split()
+    for var in vars_:
+        c[fsdecode(var)] = np.load(
+            fsdecode(os.path.join(path, var + b'.npy')),
+            mmap_mode='r',
+            allow_pickle=False,
+        )
+    os.utime(path)
+    return c
 
-def write_output(dd, filename):
+def cache_store(path, c):
+    cache = os.path.dirname(path)
+    os.makedirs(cache, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=cache, prefix=b'.tmp')
+    try:
+        for var, x in c.items():
+            with open(os.path.join(tmp, fsencode(var) + b'.npy'), 'wb') as f:
+                np.save(f, x, allow_pickle=False)
+        with open(os.path.join(tmp, b'vars'), 'wb') as f:
+            f.write(b'\n'.join([fsencode(var) for var in c.keys()]) + b'\n')
+        os.rename(tmp, path)
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.isdir(path):
+            raise
+
+def cache_evict(cache, max_size):
+    entries = []
+    for entry in os.scandir(cache):
+        if not entry.is_dir() or not re_cache_key.match(entry.name):
+            continue
+        size = sum([x.stat().st_size for x in os.scandir(entry.path)])
+        entries.append((entry.stat().st_mtime, size, entry.path))
+    total = sum([size for _, size, _ in entries])
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+def read(filename=None, options={}, data=None, format=None):
+    if filename is None and data is None:
+        raise ValueError('Either filename or data must be supplied')
+    filename = fsencode(filename) if filename is not None else None
+    format = input_format(filename, format)
+    cache = fsencode(options['cache']) \
+        if options.get('cache') is not None else None
+    if cache is not None:
+        if hasattr(data, 'read'):
+            data = data.read()
+        path = os.path.join(cache, cache_key(filename, options, data, format))
+        if os.path.isdir(path):
+            log.debug('Using cached data %s' % fsdecode(path))
+            try:
+                return cache_load(path)
+            except (OSError, ValueError) as e:
+                log.debug('Cannot read from cache: %s' % e)
+                shutil.rmtree(path, ignore_errors=True)
+    if format == 'his':
+        c = read_his(filename, options, data)
+    else:
+        c = read_dat(filename, options, data)
+    if cache is not None:
+        try:
+            cache_store(path, c)
+            cache_evict(cache, options.get('cache_size', np.inf))
+        except Exception as e:
+            log.warning('Cannot write to cache: %s' % e)
+            log.debug(traceback.format_exc())
+    return c
+
+INVENTORY_FIELDS = [
+    'file',
+    'format',
+    'size',
+    'records',
+    'malformed_lines',
+    'id',
+    'ceilometer',
+    'message_number',
+    'message_subclass',
+    'units',
+    'time_start',
+    'time_end',
+    'interval',
+    'gaps',
+    'max_gap',
+    'error',
+]
+
+def format_time(t):
+    if t is None or not np.isfinite(t):
+        return None
+    return (dt.datetime(1970, 1, 1) + dt.timedelta(seconds=float(t))) \
+        .strftime('%Y-%m-%dT%H:%M:%S')
+
+def unique(x):
+    def convert(y):
+        if isinstance(y, bytes): return fsdecode(y)
+        if isinstance(y, np.generic): return y.item()
+        return y
+    return sorted(set([convert(y) for y in x]))
+
+def scan(filename=None, options={}, data=None, format=None):
+    if filename is None and data is None:
+        raise ValueError('Either filename or data must be supplied')
+    filename = fsencode(filename) if filename is not None else None
+    format = input_format(filename, format)
+    options = dict(options, scan=True)
+    if hasattr(data, 'read'):
+        data = data.read()
+    if format == 'his':
+        dd, errors = read_his_records(filename, options, data)
+    else:
+        dd, errors = read_dat_records(filename, options, data)
+    # The inventory is built from the raw records, because records of
+    # malformed or mixed files cannot always be combined into columns.
+    def values(var):
+        return unique([d[var] for d in dd if var in d])
     n = len(dd)
-    id_ = dd[0].get('id')
-    vars = list(set(itertools.chain(*[list(d.keys()) for d in dd])))
+    time = np.array([d.get('time', np.nan) for d in dd], np.float64)
+    time = time[np.isfinite(time)]
+    dtime = np.diff(time)
+    interval = np.median(dtime[dtime > 0]) if np.any(dtime > 0) else None
+    # A gap is an interval between profiles longer than twice the typical
+    # sampling interval.
+    gaps = dtime[dtime > 2*interval] if interval is not None else np.array([])
+    return {
+        'file': fsdecode(filename) if filename is not None else None,
+        'format': format,
+        'size': memoryview(data).nbytes if data is not None \
+            else os.path.getsize(filename),
+        'records': n,
+        'malformed_lines': errors,
+        'id': values('id'),
+        'ceilometer': values('ceilometer'),
+        'message_number': values('message_number'),
+        'message_subclass': values('message_subclass'),
+        'units': unique([
+            'm' if d['status_internal'] & 0x0080 else 'ft'
+            for d in dd if 'status_internal' in d
+        ]),
+        'time_start': format_time(np.min(time)) if len(time) > 0 else None,
+        'time_end': format_time(np.max(time)) if len(time) > 0 else None,
+        'interval': float(interval) if interval is not None else None,
+        'gaps': len(gaps),
+        'max_gap': float(np.max(gaps)) if len(gaps) > 0 else None,
+        'error': None,
+    }
+
+def inventory_total(items):
+    def values(field):
+        return [x[field] for x in items if x[field] is not None]
+    def union(field):
+        return sorted(set(itertools.chain(*values(field))))
+    return {
+        'file': None,
+        'format': None,
+        'size': sum(values('size')),
+        'records': sum(values('records')),
+        'malformed_lines': sum(values('malformed_lines')),
+        'id': union('id'),
+        'ceilometer': union('ceilometer'),
+        'message_number': union('message_number'),
+        'message_subclass': union('message_subclass'),
+        'units': union('units'),
+        'time_start': min(values('time_start'), default=None),
+        'time_end': max(values('time_end'), default=None),
+        'interval': None,
+        'gaps': sum(values('gaps')),
+        'max_gap': max(values('max_gap'), default=None),
+        'error': None,
+    }
+
+def write_inventory(items, filename):
+    total = inventory_total(items)
+    if filename == b'-':
+        f = sys.stdout
+    else:
+        f = open(filename, 'w', newline='')
+    try:
+        if filename.lower().endswith(b'.csv'):
+            w = csv.DictWriter(f, INVENTORY_FIELDS)
+            w.writeheader()
+            for item in items + [total]:
+                w.writerow({
+                    k: ' '.join([str(y) for y in v]) if isinstance(v, list) else v
+                    for k, v in item.items()
+                })
+        else:
+            json.dump({'files': items, 'total': total}, f, indent=2)
+            f.write('\n')
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+def encode_backscatter(c, encoding='delta'):
+    # Raw counts are recovered from the backscatter values, which are exact
+    # multiples of scale/100/count_divisor.
+    divisor = count_divisor(c['id'][0] if 'id' in c else None)
+    scale = c['scale'][:,np.newaxis]/100
+    missing = ~np.isfinite(c['backscatter'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        counts = np.where(scale != 0, c['backscatter']/scale*divisor, 0)
+    counts = np.where(missing, 0, np.rint(counts)).astype(np.int64)
+    if encoding == 'delta':
+        counts[missing] = MISSING_COUNT
+        x = np.diff(counts, axis=0, prepend=0)
+    else:
+        x = np.where(missing, NA_INT32, counts)
+    return x.astype('i4'), divisor
+
+def decode_backscatter(f):
+    if not isinstance(f, Dataset):
+        with Dataset(fsdecode(fsencode(f))) as f:
+            return decode_backscatter(f)
+    v = f.variables['backscatter']
+    x = np.ma.getdata(v[:])
+    encoding = v.getncattr('encoding') if 'encoding' in v.ncattrs() else 'float'
+    if encoding == 'float':
+        return x
+    scale = int_to_float(np.ma.getdata(f.variables['scale'][...]))
+    scale = np.broadcast_to(scale, x.shape[0:1])
+    if encoding == 'delta':
+        counts = np.cumsum(x, axis=0, dtype=np.int64)
+        missing = counts == v.missing_count
+    elif encoding == 'counts':
+        counts = x
+        missing = x == NA_INT32
+    else:
+        raise ValueError('Unsupported backscatter encoding "%s"' % encoding)
+    return np.where(
+        missing,
+        np.nan,
+        int_to_float(counts)/v.count_divisor*(scale[:,np.newaxis]/100)
+    )
 
-    if os.path.dirname(filename) != b'' and \
-        not os.path.exists(os.path.dirname(filename)):
-        raise Exception('%s: No such file or directory' % fsdecode(filename))
+def write_output(c, filename=None, append=False, compact=True,
+    backscatter_encoding='float'):
+    n = len(c['time'])
+    id_ = c['id'][0] if 'id' in c else None
+    vars = list(c.keys())
+    if backscatter_encoding not in BACKSCATTER_ENCODINGS:
+        raise ValueError('Invalid backscatter encoding "%s"' % backscatter_encoding)
+    if backscatter_encoding == 'delta' and append:
+        raise ValueError('Delta encoding of backscatter cannot be used when appending')
+    # Appended records may differ from records already in the file.
+    compact = compact and not append
+    constant = [
+        var for var in COMPACT_VARS
+        if compact and var in c and np.all(c[var] == c[var][0])
+    ] if n > 0 else []
+
+    if filename is None:
+        # Create the dataset in memory and return its content.
+        f = Dataset('cl2nc.nc', 'w', format='NETCDF4', memory=1)
+    else:
+        filename = fsencode(filename)
+        if os.path.dirname(filename) != b'' and \
+            not os.path.exists(os.path.dirname(filename)):
+            raise Exception('%s: No such file or directory' % fsdecode(filename))
+        if append and os.path.exists(filename):
+            f = Dataset(fsdecode(filename), 'a')
+        else:
+            f = Dataset(fsdecode(filename), 'w', format='NETCDF4')
 
-    f = Dataset(fsdecode(filename), 'w', format='NETCDF4')
-    f.createDimension('time', n)
+    # When appending, records are written after the existing records along an
+    # unlimited time dimension.
+    new = 'time' not in f.dimensions
+    i = 0 if new else len(f.dimensions['time'])
+    if new:
+        f.createDimension('time', None if append else n)
 
+    new_level = 'backscatter' in vars and 'level' not in f.dimensions
     if 'backscatter' in vars:
-        m = np.max([0] + [len(d['backscatter']) for d in dd])
-        f.createDimension('level', m)
-        level = np.arange(m)
+        m = c['backscatter'].shape[1]
+        if new_level:
+            f.createDimension('level', m)
+            level = np.arange(m)
+        elif len(f.dimensions['level']) != m:
+            f.close()
+            raise ValueError('Number of levels (%d) differs from the existing file (%d)' % (
+                m, len(f.dimensions['level'])
+            ))
+        if 'backscatter' in f.variables and backscatter_encoding != (
+            f['backscatter'].getncattr('encoding')
+            if 'encoding' in f['backscatter'].ncattrs() else 'float'
+        ):
+            f.close()
+            raise ValueError('Backscatter encoding differs from the existing file')
 
     has_layers = 'layer_height' in vars or 'layer_cloud_amount' in vars
-    if has_layers:
+    new_layer = has_layers and 'layer' not in f.dimensions
+    if new_layer:
         f.createDimension('layer', 5)
         layer = np.arange(5)
 
-    def write_var(var, dtype, attributes={}):
-        if not var in vars: return
+    def create_var(var, dtype, dims, attributes, **kwargs):
+        if var in f.variables:
+            return f.variables[var]
         fill_value = NA_NETCDF.get(dtype)
-        if dtype == 'SX':
-            slen = max([len(d[var]) for d in dd])
-            dtype = 'S%d' % slen
-        v = f.createVariable(var, dtype, ('time',), fill_value=fill_value)
-        v[:] = np.array([d[var] for d in dd])
+        v = f.createVariable(var, dtype, dims, fill_value=fill_value, **kwargs)
         v.setncatts(attributes)
+        return v
+
+    def write_var(var, dtype, attributes={}, x=None):
+        if not var in vars: return
+        x = c[var] if x is None else x
+        if dtype == 'SX':
+            dtype = 'S%d' % x.dtype.itemsize
+        if var in constant:
+            v = create_var(var, dtype, (), attributes)
+            v[...] = x[0]
+            return
+        if compact and var in ENUM_VARS:
+            values = np.unique(x)
+            if len(values) < 256 and \
+                all([re_enum_name.match(y) for y in values]):
+                dtype = f.createEnumType('u1', var + '_type', {
+                    y.decode('ascii'): j for j, y in enumerate(values)
+                })
+                x = np.searchsorted(values, x).astype('u1')
+        v = create_var(var, dtype, ('time',), attributes)
+        v[i:(i + n)] = x
 
     def write_profile(var, dtype, attributes={}):
         if not var in vars: return
-        fill_value = NA_NETCDF.get(dtype)
-        v = f.createVariable(var, dtype, ('time', 'level'), fill_value=fill_value)
-        for i, d in enumerate(dd):
-            x = d[var]
-            v[i, 0:len(x)] = x
-        v.setncatts(attributes)
+        v = create_var(var, dtype, ('time', 'level'), attributes)
+        v[i:(i + n)] = c[var]
 
     def write_layer(var, dtype, attributes={}):
         if not var in vars: return
-        fill_value = NA_NETCDF.get(dtype)
-        v = f.createVariable(var, dtype, ('time', 'layer'), fill_value=fill_value)
-        for i, d in enumerate(dd):
-            x = d[var]
-            v[i, 0:len(x)] = x
-        v.setncatts(attributes)
+        v = create_var(var, dtype, ('time', 'layer'), attributes)
+        v[i:(i + n)] = c[var]
 
     def write_dim(var, dtype, x, attributes={}):
         v = f.createVariable(var, dtype, (var,))
@@ -594,18 +1057,45 @@ def write_output(dd, filename):
         'standard_name': 'time',
         'units': 'seconds since 1970-01-01 00:00:00 UTC',
     })
-    if 'backscatter' in vars:
+    if new_level:
         write_dim('level', 'i4', level, {
             'long_name': 'level number',
         })
-    if has_layers:
+    if new_layer:
         write_dim('layer', 'i4', layer, {
             'long_name': 'layer number',
         })
-    write_profile('backscatter', 'f4', {
-        'long_name': 'attenuated volume backscattering coefficient',
-        'units': 'km^-1.sr^-1',
-    })
+    if backscatter_encoding == 'float':
+        write_profile('backscatter', 'f4', {
+            'long_name': 'attenuated volume backscattering coefficient',
+            'units': 'km^-1.sr^-1',
+        })
+    elif 'backscatter' in vars:
+        x, divisor = encode_backscatter(c, backscatter_encoding)
+        if backscatter_encoding == 'delta':
+            attributes = {
+                'long_name': 'attenuated volume backscattering coefficient (raw counts delta-encoded along time)',
+                'units': '1',
+                'encoding': 'delta',
+                'count_divisor': divisor,
+                'missing_count': MISSING_COUNT,
+                'comment': 'backscatter (km^-1.sr^-1) = cumsum(backscatter, time)/count_divisor*scale/100, missing where the cumulative sum is missing_count; see cl2nc.decode_backscatter',
+            }
+        else:
+            attributes = {
+                'long_name': 'attenuated volume backscattering coefficient (raw counts)',
+                'units': '1',
+                'encoding': 'counts',
+                'count_divisor': divisor,
+                'comment': 'backscatter (km^-1.sr^-1) = backscatter/count_divisor*scale/100; see cl2nc.decode_backscatter',
+            }
+        v = create_var('backscatter', 'i4', ('time', 'level'), attributes,
+            zlib=True, shuffle=True)
+        v[i:(i + n)] = x
+        write_var('scale', 'i4', {
+            'long_name': 'scale parameter',
+            'units': '%',
+        }, np.where(np.isnan(c['scale']), NA_INT32, c['scale']).astype('i4'))
     write_var('unit', 'S1', {
         'long_name': 'unit identification character',
     })
@@ -778,9 +1268,335 @@ def write_output(dd, filename):
 
     f.software = 'cl2nc (https://github.com/peterkuma/cl2nc)'
     f.version = __version__
-    f.created = dt.datetime.now(dt.UTC).strftime('%Y-%m-%dT%H:%M:%SZ')
+    if new:
+        f.created = dt.datetime.now(dt.UTC).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    return f.close()
+
+class LogBuffer(logging.Filter):
+    def __init__(self):
+        super().__init__()
+        self.thread = threading.get_ident()
+        self.records = []
+
+    def filter(self, record):
+        if threading.get_ident() != self.thread:
+            return True
+        self.records.append(record)
+        return False
+
+def write(c, filename, compact=True, backscatter_encoding='float'):
+    if len(c) == 0:
+        log.warning('No output was created because the input file has no records')
+    elif filename == b'-':
+        buf = write_output(c,
+            compact=compact,
+            backscatter_encoding=backscatter_encoding
+        )
+        sys.stdout.buffer.write(buf)
+        sys.stdout.buffer.flush()
+    else:
+        write_output(c, filename,
+            compact=compact,
+            backscatter_encoding=backscatter_encoding
+        )
+
+def match_path(name, path, patterns):
+    for pattern in patterns:
+        if fnmatch.fnmatch(path if b'/' in pattern else name, pattern):
+            return True
+    return False
+
+def is_input_file(name):
+    name_lower = name.lower()
+    return name_lower.endswith(b'.dat') or name_lower.endswith(b'.his')
+
+def walk(dirname, include=None, exclude=[], recursive=False, path=b'',
+    visited=None):
+    # Directories are identified by device and inode, so that symbolic links
+    # to directories are followed, but each directory is walked only once.
+    visited = set() if visited is None else visited
+    try:
+        st = os.stat(dirname)
+        if (st.st_dev, st.st_ino) in visited:
+            return
+        visited.add((st.st_dev, st.st_ino))
+        entries = sorted(os.scandir(dirname), key=lambda entry: entry.name)
+    except OSError as e:
+        log.warning(e)
+        return
+    for entry in entries:
+        entry_path = path + b'/' + entry.name if path != b'' else entry.name
+        if match_path(entry.name, entry_path, exclude):
+            continue
+        try:
+            is_dir = entry.is_dir()
+        except OSError as e:
+            log.warning(e)
+            continue
+        if is_dir:
+            if recursive:
+                yield from walk(entry.path, include, exclude, recursive,
+                    entry_path, visited)
+            continue
+        if include is None:
+            if not is_input_file(entry.name):
+                continue
+        elif not match_path(entry.name, entry_path, include):
+            continue
+        yield entry, entry_path
+
+def shard(entries, i, n, by='hash'):
+    load = np.zeros(n)
+    for entry, path in entries:
+        if by == 'size':
+            # Assign files to the least loaded shard. The assignment is the
+            # same on all nodes because the directory is traversed in the same
+            # order.
+            k = np.argmin(load)
+            load[k] += entry.stat().st_size
+        else:
+            k = int(hashlib.sha256(path).hexdigest(), 16) % n
+        if k == i - 1:
+            yield entry, path
+
+def input_files(input_, include=None, exclude=[], recursive=False,
+    shard_=None, shard_by='hash'):
+    entries = walk(input_, include, exclude, recursive)
+    if shard_ is not None:
+        entries = shard(entries, shard_[0], shard_[1], shard_by)
+    return entries
+
+def dir_jobs(input_, output, **kwargs):
+    for entry, path in input_files(input_, **kwargs):
+        output_filename = os.path.join(
+            output,
+            os.path.splitext(path)[0] + b'.nc'
+        )
+        yield entry.path, output_filename
+
+def convert(input_filename, output_filename, options):
+    try:
+        c = read(input_filename, options)
+        if options.get('makedirs'):
+            os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+        write(c, output_filename,
+            options.get('compact', True),
+            options.get('backscatter_encoding', 'float')
+        )
+    except Exception as e:
+        log.error(e)
+        log.debug(traceback.format_exc())
+
+def convert_pipelined(jobs, options, quiet=False):
+    prefetched = queue.Queue(PIPELINE_QUEUE_SIZE)
+    parsed = queue.Queue(PIPELINE_QUEUE_SIZE)
+
+    # Exceptions raised in the threads are re-raised in the calling thread.
+    errors = []
+    stop = threading.Event()
+
+    def prefetch_thread():
+        try:
+            for input_filename, output_filename in jobs:
+                if stop.is_set():
+                    break
+                try:
+                    with open(input_filename, 'rb') as f:
+                        data = f.read()
+                except Exception:
+                    # The error is reported when the file is read again by
+                    # the parser.
+                    data = None
+                prefetched.put((input_filename, output_filename, data))
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            prefetched.put(None)
+
+    def write_thread():
+        try:
+            while True:
+                job = parsed.get()
+                if job is None:
+                    return
+                input_filename, output_filename, c, records = job
+                if not quiet:
+                    print(fsdecode(input_filename))
+                for record in records:
+                    log.handle(record)
+                if c is None:
+                    continue
+                try:
+                    if options.get('makedirs'):
+                        os.makedirs(os.path.dirname(output_filename),
+                            exist_ok=True)
+                    write(c, output_filename,
+                        options.get('compact', True),
+                        options.get('backscatter_encoding', 'float')
+                    )
+                except Exception as e:
+                    log.error(e)
+                    log.debug(traceback.format_exc())
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+            # Consume the remaining jobs so that the main thread does not
+            # block.
+            while parsed.get() is not None:
+                pass
+
+    threads = [
+        threading.Thread(target=prefetch_thread, daemon=True),
+        threading.Thread(target=write_thread, daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    while True:
+        job = prefetched.get()
+        if job is None:
+            break
+        if stop.is_set():
+            continue
+        input_filename, output_filename, data = job
+        # Log messages are passed to the write thread so that they are
+        # printed in the order of input files.
+        buf = LogBuffer()
+        log.addFilter(buf)
+        try:
+            c = read(input_filename, options, data)
+        except Exception as e:
+            c = None
+            log.error(e)
+            log.debug(traceback.format_exc())
+        finally:
+            log.removeFilter(buf)
+        del data
+        parsed.put((input_filename, output_filename, c, buf.records))
+    parsed.put(None)
+
+    for thread in threads:
+        thread.join()
+
+    if len(errors) > 0:
+        raise errors[0]
+
+def stream_filename(output, name, t, roll='day'):
+    period = (dt.datetime(1970, 1, 1) + dt.timedelta(seconds=t)) \
+        .strftime(ROLL_FORMAT[roll])
+    return os.path.join(output, fsencode('%s_%s.nc' % (name, period)))
+
+def write_stream(dd, output, name, roll='day', backscatter_encoding='float'):
+    # Returns records which could not be written (e.g. because the file is
+    # locked by a reader), so that writing can be retried later.
+    failed = []
+    # Records with different variables (e.g. with and without sky condition
+    # data) cannot be combined into columns.
+    for _, group in itertools.groupby(dd, lambda d: sorted(d.keys())):
+        group = list(group)
+        c = postprocess(group)
+        filenames = np.array([
+            stream_filename(output, name, t, roll) if np.isfinite(t) else b''
+            for t in c['time']
+        ])
+        if np.any(filenames == b''):
+            log.warning('%s: Skipping records with invalid time' % name)
+        for filename in dict.fromkeys(filenames):
+            if filename == b'':
+                continue
+            mask = filenames == filename
+            try:
+                write_output(
+                    {k: v[mask] for k, v in c.items()},
+                    filename,
+                    append=True,
+                    backscatter_encoding=backscatter_encoding
+                )
+            except Exception as e:
+                if isinstance(e, OSError) and e.errno in TRANSIENT_ERRORS:
+                    log.warning('%s: %s, retrying later' % (name, e))
+                    failed += [d for d, x in zip(group, mask) if x]
+                else:
+                    log.error('%s: %s, discarding %d records' % (
+                        name, e, np.sum(mask)
+                    ))
+                    log.debug(traceback.format_exc())
+    return failed
+
+def listen(addresses, output, options, roll='day', quiet=False):
+    options = dict(options, time=None, sampling_rate=None)
+    os.makedirs(output, exist_ok=True)
+    # All output is written by a single thread, because HDF5 is not
+    # thread-safe.
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def clock():
+        return dt.datetime.now(dt.UTC).timestamp()
+
+    def handler(name):
+        async def handle(reader, writer):
+            loop = asyncio.get_running_loop()
+            peer = writer.get_extra_info('peername')
+            if not quiet:
+                print('%s: Connection from %s' % (name, peer))
+            parser = DatParser(options=options, clock=clock)
+            line_number = 0
+            # Records which could not be written and the time of the first
+            # failure.
+            pending = []
+            pending_time = None
+            try:
+                while True:
+                    line = await reader.readline()
+                    if line == b'':
+                        break
+                    line_number += 1
+                    parser.feed(line, line_number)
+                    if len(parser.dd) > 0:
+                        dd = pending + parser.dd
+                        parser.dd = []
+                        pending = await loop.run_in_executor(executor,
+                            write_stream, dd, output, name, roll,
+                            options.get('backscatter_encoding', 'float'))
+                        if len(pending) == 0:
+                            pending_time = None
+                        elif pending_time is None:
+                            pending_time = clock()
+                        if len(pending) > 0 and \
+                            clock() - pending_time > PENDING_AGE:
+                            log.error('%s: Discarding %d records which could not be written in %d s' % (
+                                name, len(pending), PENDING_AGE
+                            ))
+                            pending = []
+                            pending_time = None
+                        elif len(pending) > PENDING_SIZE:
+                            log.error('%s: Discarding %d records which could not be written' % (
+                                name, len(pending) - PENDING_SIZE
+                            ))
+                            pending = pending[-PENDING_SIZE:]
+                if len(pending) > 0:
+                    log.error('%s: Discarding %d unwritten records' % (
+                        name, len(pending)
+                    ))
+            except Exception as e:
+                log.error('%s: %s' % (name, e))
+                log.debug(traceback.format_exc())
+            finally:
+                writer.close()
+            if not quiet:
+                print('%s: Connection from %s closed' % (name, peer))
+        return handle
+
+    async def run():
+        servers = []
+        for name, host, port in addresses:
+            servers += [await asyncio.start_server(handler(name), host, port,
+                limit=1<<20)]
+        await asyncio.gather(*[server.serve_forever() for server in servers])
 
-    f.close()
+    asyncio.run(run())
 
 def parse_iso_time(s):
     if s is None: return None
@@ -799,6 +1615,25 @@ def parse_float(s):
     except ValueError:
         log.warning('Invalid floating-point format "%s"' % s)
 
+def parse_listen(s):
+    name, _, address = s.rpartition('=')
+    host, _, port = address.rpartition(':')
+    try:
+        port = int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid address "%s"' % s)
+    host = host.strip('[]') if host != '' else None
+    return (name if name != '' else str(port)), host, port
+
+def parse_shard(s):
+    try:
+        i, n = [int(x) for x in s.split('/')]
+    except ValueError:
+        i, n = 0, 0
+    if not (n > 0 and i >= 1 and i <= n):
+        raise argparse.ArgumentTypeError('invalid shard "%s"' % s)
+    return i, n
+
 def main():
     parser = argparse.ArgumentParser(description='Convert Vaisala CL51 and CL31 DAT and HIS L2 files to NetCDF')
     parser.add_argument('-v',
@@ -828,53 +1663,168 @@ def main():
         dest='sampling_rate',
         help='profile sampling rate in seconds for use with files with no timestamps',
     )
-    parser.add_argument('input', help='input file')
-    parser.add_argument('output', help='output file')
+    parser.add_argument('--cache',
+        dest='cache',
+        help='directory for caching parsed input files',
+    )
+    parser.add_argument('--cache-size',
+        dest='cache_size',
+        default='1000',
+        help='maximum cache size in MB (default: 1000)',
+    )
+    parser.add_argument('--pipeline',
+        dest='pipeline',
+        action='store_true',
+        help='read, parse and write files in parallel in directory mode',
+    )
+    parser.add_argument('-r',
+        dest='recursive',
+        action='store_true',
+        help='convert files in subdirectories of the input directory',
+    )
+    parser.add_argument('--include',
+        dest='include',
+        action='append',
+        metavar='PATTERN',
+        help='convert only files matching a pattern in directory mode (can be specified multiple times)',
+    )
+    parser.add_argument('--exclude',
+        dest='exclude',
+        action='append',
+        metavar='PATTERN',
+        help='skip files and directories matching a pattern in directory mode (can be specified multiple times)',
+    )
+    parser.add_argument('--shard',
+        dest='shard',
+        type=parse_shard,
+        metavar='I/N',
+        help='convert only the I-th of N disjoint subsets of the input files in directory mode',
+    )
+    parser.add_argument('--shard-by',
+        dest='shard_by',
+        choices=['hash', 'size'],
+        default='hash',
+        help='split input files into subsets by path hash or by size (default: hash)',
+    )
+    parser.add_argument('--backscatter-encoding',
+        dest='backscatter_encoding',
+        choices=BACKSCATTER_ENCODINGS,
+        default='float',
+        help='store backscatter as floating-point values, or losslessly as compressed raw counts (counts) or compressed raw counts delta-encoded along time (delta) (default: float)',
+    )
+    parser.add_argument('--no-compact',
+        dest='no_compact',
+        action='store_true',
+        help='store all variables along the time dimension as in previous versions',
+    )
+    parser.add_argument('--scan',
+        dest='scan',
+        action='store_true',
+        help='write an inventory of input files instead of converting them',
+    )
+    parser.add_argument('--listen',
+        dest='listen',
+        type=parse_listen,
+        action='append',
+        metavar='[NAME=][HOST:]PORT',
+        help='receive messages from an instrument on a TCP port and write them to the output directory (can be specified multiple times)',
+    )
+    parser.add_argument('--roll',
+        dest='roll',
+        choices=list(ROLL_FORMAT.keys()),
+        default='day',
+        help='start a new output file every hour or day with --listen (default: day)',
+    )
+    parser.add_argument('input', nargs='?', help='input file')
+    parser.add_argument('output', nargs='?', help='output file or "-" for standard output')
     args = parser.parse_args()
 
+    if args.listen is not None:
+        if args.input is None or args.output is not None:
+            parser.error('--listen requires exactly one output directory')
+        if args.backscatter_encoding == 'delta':
+            parser.error('--backscatter-encoding delta cannot be used with --listen')
+    elif args.input is None or args.output is None:
+        parser.error('the following arguments are required: input, output')
+
     if args.debug:
         log.setLevel('DEBUG')
 
-    input_ = fsencode(args.input)
-    output = fsencode(args.output)
+    cache_size = parse_float(args.cache_size)
 
     options = {
         'check': args.check,
         'time': parse_iso_time(args.time),
         'sampling_rate': parse_float(args.sampling_rate),
+        'cache': fsencode(args.cache) if args.cache is not None else None,
+        'cache_size': cache_size*1e6 if cache_size is not None else np.inf,
+        'compact': not args.no_compact,
+        'backscatter_encoding': args.backscatter_encoding,
     }
 
-    if os.path.isdir(input_):
-        for file_ in sorted([fsencode(x) for x in os.listdir(input_)]):
-            file_lower = file_.lower()
-            if not (file_lower.endswith(b'.dat') or file_lower.endswith(b'.his')):
-                continue
-            input_filename = os.path.join(input_, file_)
-            output_filename = os.path.join(
-                output,
-                os.path.splitext(file_)[0] + b'.nc'
+    if args.listen is not None:
+        listen(args.listen, fsencode(args.input), options, args.roll,
+            args.quiet)
+        return
+
+    input_ = fsencode(args.input)
+    output = fsencode(args.output)
+
+    if not args.scan and output == b'-' and os.path.isdir(input_):
+        parser.error('output "-" cannot be used with an input directory')
+
+    if args.scan:
+        if os.path.isdir(input_):
+            entries = input_files(input_,
+                include=[fsencode(x) for x in args.include] \
+                    if args.include is not None else None,
+                exclude=[fsencode(x) for x in args.exclude or []],
+                recursive=args.recursive,
+                shard_=args.shard,
+                shard_by=args.shard_by,
             )
-            if not args.quiet:
-                print(fsdecode(input_filename))
+            filenames = (entry.path for entry, _ in entries)
+        else:
+            filenames = [input_]
+        items = []
+        for filename in filenames:
+            if not args.quiet and output != b'-':
+                print(fsdecode(filename))
             try:
-                dd = read(input_filename, options)
-                if len(dd) > 0:
-                    write_output(dd, output_filename)
-                else:
-                    log.warning('No output was created because the input file has no records')
+                items.append(scan(filename, options))
             except Exception as e:
                 log.error(e)
                 log.debug(traceback.format_exc())
-    else:
+                item = {k: None for k in INVENTORY_FIELDS}
+                item['file'] = fsdecode(filename)
+                item['error'] = str(e)
+                items.append(item)
         try:
-            dd = read(input_, options)
-            if len(dd) > 0:
-                write_output(dd, output)
-            else:
-                log.warning('No output was created because the input file has no records')
+            write_inventory(items, output)
         except Exception as e:
             log.error(e)
             log.debug(traceback.format_exc())
+    elif os.path.isdir(input_):
+        jobs = dir_jobs(input_, output,
+            include=[fsencode(x) for x in args.include] \
+                if args.include is not None else None,
+            exclude=[fsencode(x) for x in args.exclude or []],
+            recursive=args.recursive,
+            shard_=args.shard,
+            shard_by=args.shard_by,
+        )
+        # Output subdirectories are created when writing, so that errors
+        # are reported per file.
+        options = dict(options, makedirs=args.recursive)
+        if args.pipeline:
+            convert_pipelined(jobs, options, args.quiet)
+        else:
+            for input_filename, output_filename in jobs:
+                if not args.quiet:
+                    print(fsdecode(input_filename))
+                convert(input_filename, output_filename, options)
+    else:
+        convert(input_, output, options)
 
 if __name__ == '__main__':
     main()
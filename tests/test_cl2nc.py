@@ -0,0 +1,150 @@
+import numpy as np
+import pytest
+import cl2nc
+
+OPTIONS = {'check': False, 'time': None, 'sampling_rate': None}
+
+def dat_record(time, line6=True, message_number=2):
+    return b'\r\n'.join([
+        b'-' + time,
+        b'\x01CL0001%d6\x02' % message_number,
+        b'10 01230 ///// ///// 000000000080',
+    ] + ([
+        b'  1 0030 0 //// 0 //// 0 //// 0 ////',
+    ] if message_number == 2 else []) + [
+        b'00100 10 0770 100 +33 099 00 0110 L0016HN15 139',
+        b'00010'*770,
+    ] + ([b'\x03ABCD\x04'] if line6 else [])) + b'\r\n'
+
+def ct_record(time, scale=b'100', nvalues=16):
+    return b'\r\n'.join([
+        b'-' + time,
+        b'\x01CTA2020\x02',
+        b'10 01230 ///// ///// 00000100',
+        scale + b' N 100 +25 099 0100 000 0100 LF2HN1 139',
+    ] + [
+        b'%03d' % (i*16) + b''.join([
+            b'%04x' % ((i*16 + j)*37 % 0x10000) for j in range(nvalues)
+        ])
+        for i in range(16)
+    ] + [
+        b'\x03',
+    ]) + b'\r\n'
+
+def test_missing_line6(tmp_path):
+    data = dat_record(b'2020-01-01 00:00:00') + \
+        dat_record(b'2020-01-01 00:00:16', line6=False) + \
+        dat_record(b'2020-01-01 00:00:32')
+    c = cl2nc.read(data=data, format='dat', options=OPTIONS)
+    assert len(c['time']) == 3
+    assert 'checksum' not in c
+    cl2nc.write_output(c, tmp_path/'output.nc')
+
+def test_scan_malformed():
+    data = dat_record(b'2020-01-01 00:00:00') + \
+        dat_record(b'2020-01-01 00:00:16', line6=False) + \
+        dat_record(b'2020-01-01 00:00:32', message_number=1) + \
+        dat_record(b'2020-01-01 00:00:48')
+    item = cl2nc.scan(data=data, format='dat', options=OPTIONS)
+    assert item['records'] == 4
+    assert item['message_number'] == [1, 2]
+    assert item['units'] == ['m']
+    assert item['time_start'] == '2020-01-01T00:00:00'
+    assert item['time_end'] == '2020-01-01T00:00:48'
+
+def test_pipeline_jobs_error():
+    def jobs():
+        yield from []
+        raise OSError('jobs failed')
+    with pytest.raises(OSError, match='jobs failed'):
+        cl2nc.convert_pipelined(jobs(), OPTIONS, quiet=True)
+
+class WriteError(BaseException):
+    pass
+
+def test_pipeline_write_error(tmp_path, monkeypatch):
+    def write(*args):
+        raise WriteError()
+    monkeypatch.setattr(cl2nc, 'write', write)
+    input_ = tmp_path/'input.dat'
+    input_.write_bytes(dat_record(b'2020-01-01 00:00:00'))
+    jobs = [(bytes(input_), bytes(tmp_path/('%d.nc' % i))) for i in range(10)]
+    with pytest.raises(WriteError):
+        cl2nc.convert_pipelined(jobs, OPTIONS, quiet=True)
+
+def test_walk_symlink_loop(tmp_path):
+    (tmp_path/'a').mkdir()
+    (tmp_path/'a'/'input.dat').write_bytes(b'')
+    (tmp_path/'a'/'loop').symlink_to(tmp_path)
+    paths = [path for _, path in cl2nc.walk(bytes(tmp_path), recursive=True)]
+    assert paths == [b'a/input.dat']
+
+def test_cache_str_path(tmp_path):
+    input_ = tmp_path/'input.dat'
+    input_.write_bytes(dat_record(b'2020-01-01 00:00:00'))
+    options = dict(OPTIONS, cache=str(tmp_path/'cache'))
+    c1 = cl2nc.read(str(input_), options)
+    c2 = cl2nc.read(str(input_), options)
+    assert len(list((tmp_path/'cache').iterdir())) == 1
+    assert np.array_equal(c1['backscatter'], c2['backscatter'])
+
+def stream_records():
+    parser = cl2nc.DatParser(options=OPTIONS)
+    data = dat_record(b'2020-01-01 00:00:00') + \
+        dat_record(b'2020-01-01 00:00:16')
+    for i, line in enumerate(data.splitlines(True)):
+        parser.feed(line, i + 1)
+    return parser.dd
+
+def test_write_stream_transient_error(tmp_path, monkeypatch):
+    def write_output(*args, **kwargs):
+        raise OSError(-101, 'NetCDF: HDF error')
+    monkeypatch.setattr(cl2nc, 'write_output', write_output)
+    dd = stream_records()
+    assert cl2nc.write_stream(dd, bytes(tmp_path), 'a') == dd
+
+def test_write_stream_error(tmp_path):
+    (tmp_path/'a_20200101.nc').write_bytes(b'invalid')
+    assert cl2nc.write_stream(stream_records(), bytes(tmp_path), 'a') == []
+
+def test_cache_partial_entry(tmp_path):
+    input_ = tmp_path/'input.dat'
+    input_.write_bytes(dat_record(b'2020-01-01 00:00:00'))
+    options = dict(OPTIONS, cache=str(tmp_path/'cache'))
+    c1 = cl2nc.read(str(input_), options)
+    path, = (tmp_path/'cache').iterdir()
+    (path/'backscatter.npy').unlink()
+    c2 = cl2nc.read(str(input_), options)
+    assert np.array_equal(c1['backscatter'], c2['backscatter'])
+    assert (path/'backscatter.npy').exists()
+
+def test_default_options():
+    data = b''.join([
+        b'\r\n'.join(dat_record(b'2020-01-01 00:00:00').split(b'\r\n')[1:])
+        for i in range(2)
+    ])
+    c = cl2nc.read(data=data, format='dat')
+    assert len(c['backscatter']) == 2
+
+@pytest.mark.parametrize('encoding', ['counts', 'delta'])
+@pytest.mark.parametrize('data', [
+    dat_record(b'2020-01-01 00:00:00') + dat_record(b'2020-01-01 00:00:16'),
+    ct_record(b'2020-01-01 00:00:00') + \
+    ct_record(b'2020-01-01 00:00:15', nvalues=10) + \
+    ct_record(b'2020-01-01 00:00:30', scale=b'///') + \
+    ct_record(b'2020-01-01 00:00:45', scale=b'050'),
+])
+def test_backscatter_encoding(tmp_path, encoding, data):
+    c = cl2nc.read(data=data, format='dat', options=OPTIONS)
+    filename = tmp_path/'output.nc'
+    cl2nc.write_output(c, filename, backscatter_encoding=encoding)
+    x = cl2nc.decode_backscatter(filename)
+    assert np.array_equal(x, c['backscatter'], equal_nan=True)
+
+def test_write_stream_encoding(tmp_path):
+    dd = stream_records()
+    c = cl2nc.postprocess(dd)
+    assert cl2nc.write_stream(dd, bytes(tmp_path), 'a',
+        backscatter_encoding='counts') == []
+    x = cl2nc.decode_backscatter(tmp_path/'a_20200101.nc')
+    assert np.array_equal(x, c['backscatter'], equal_nan=True)